@@ -5,18 +5,35 @@ Ref https://github.com/fonttools/fonttools/blob/main/Lib/fontTools/fontBuilder.p
 from absl import app
 from absl import flags
 from absl import logging
-from base64 import b64encode
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
 from fontTools import ttLib
 from fontTools.ttLib.ttFont import TTFont
 from fontTools.fontBuilder import FontBuilder
+from fontTools.misc.roundTools import otRound
+from fontTools.pens.cu2quPen import Cu2QuPen
 from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.svgLib.path import parse_path
 from fontTools.ttLib.tables._c_m_a_p import cmap_classes
+from fontTools.ttLib.tables.O_S_2f_2 import table_O_S_2f_2
+from picosvg.svg import SVG
+from picosvg.svg_transform import Affine2D
+import concurrent.futures
+import io
+import itertools
 import os
 import pathlib
 import shutil
+import struct
 import subprocess
+import sys
 import tempfile
 
+try:
+    # Optional SIMD accelerated drop-in for the stdlib encoder
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
 
 FLAGS = flags.FLAGS
 
@@ -53,15 +70,120 @@ flags.DEFINE_integer(
 FAMILY_NAME = "Tofu"
 FONT_FILENAME = "tofu.ttf"
 TOFU_SOURCE_DIR = "source"
-GLYPH_NAME = 'tofu'
+# Interned so every cmap value references the same string object
+GLYPH_NAME = sys.intern('tofu')
+STYLE_NAME = 'Regular'
+CSS_B64_CHUNK_SIZE = 3 * 2730
+SCRIPT_PATH = pathlib.Path(__file__).parent
+
+# Defaults of nanoemoji's FontConfig (nanoemoji/config.py), so both build paths
+# produce the same metrics. They can't be read from nanoemoji.config directly:
+# importing it defines absl flags (width, ascender, ...) that clash with ours.
+# Keep in sync when bumping nanoemoji (pinned in requirements.txt).
+DEFAULT_VERSION_MAJOR = 1
+DEFAULT_VERSION_MINOR = 0
+DEFAULT_ASCENDER = 950
+DEFAULT_DESCENDER = -250
+DEFAULT_LINE_GAP = 0
+DEFAULT_UNITS_PER_EM = 1024
+DEFAULT_WIDTH = 1275
+
+# .notdef is left empty; the tofu glyph itself is drawn per build as it depends on the metric flags
+NOTDEF_GLYPH = TTGlyphPen(None).glyph()
+
+
+class _TofuCmap(Mapping):
+    """
+    Read-only codepoint to glyph name mapping for the format 13 subtable.
+
+    Maps everything from U+0002 up to GLYPH_NAME, except the emoji presentation
+    selector U+FE0F, without materializing a dict of ~1.1M entries. Keys come
+    out already sorted, and the keys/values/items views iterate in C via
+    itertools for the parts of fontTools that still walk the mapping (e.g. ttx
+    dumps, the subsetter).
+    """
+
+    _RANGES = (range(2, 0xFE0F), range(0xFE0F + 1, 0x10FFFF + 1))
+    _LEN = sum(len(r) for r in _RANGES)
+
+    def __getitem__(self, cp):
+        if cp in self:
+            return GLYPH_NAME
+        raise KeyError(cp)
+
+    def __contains__(self, cp):
+        low, high = self._RANGES
+        return cp in low or cp in high
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._RANGES)
+
+    def __len__(self):
+        return self._LEN
+
+    def keys(self):
+        return _TofuCmapKeys(self)
+
+    def values(self):
+        return _TofuCmapValues(self)
+
+    def items(self):
+        return _TofuCmapItems(self)
+
 
+class _TofuCmapKeys(KeysView):
+    def __iter__(self):
+        return iter(self._mapping)
 
-def _script_path() -> pathlib.Path:
-    return pathlib.Path(__file__).parent
+
+class _TofuCmapValues(ValuesView):
+    def __iter__(self):
+        return itertools.repeat(GLYPH_NAME, len(self._mapping))
+
+
+class _TofuCmapItems(ItemsView):
+    def __iter__(self):
+        return zip(iter(self._mapping), itertools.repeat(GLYPH_NAME, len(self._mapping)))
+
+
+class _TofuCmapSubtable(cmap_classes[13]):
+    """
+    Format 13 subtable mapping _TofuCmap to the tofu glyph.
+
+    fontTools' compiler has no range input: it lists, sorts and walks every
+    codepoint to rediscover the groups. We already know them, so compile()
+    packs the header and one group per range directly.
+    """
+
+    def __init__(self):
+        super().__init__(13)
+        self.cmap = _TofuCmap()
+
+    def compile(self, ttFont):
+        glyph_id = ttFont.getGlyphID(GLYPH_NAME)
+        groups = b''.join(struct.pack('>LLL', r.start, r.stop - 1, glyph_id)
+                          for r in _TofuCmap._RANGES)
+        header = struct.pack(self.headerFormat, self.format, self.reserved,
+                             struct.calcsize(self.headerFormat) + len(groups),
+                             self.language, len(_TofuCmap._RANGES))
+        return header + groups
+
+
+class _TofuOS2(table_O_S_2f_2):
+    """
+    OS/2 table with fixed first/last char indices.
+
+    fontTools recomputes them on every compile by collecting the keys of every
+    Unicode cmap subtable into a set, which for _TofuCmap means ~1.1M ints.
+    The tofu cmap always spans U+0001 to beyond U+FFFF, so they're set up front.
+    """
+
+    def updateFirstAndLastCharIndex(self, ttFont):
+        pass
 
 
 def _tofu_source_svg_path() -> pathlib.Path:
-    return _script_path() / TOFU_SOURCE_DIR / FLAGS.tofu_source_svg
+    return SCRIPT_PATH / TOFU_SOURCE_DIR / FLAGS.tofu_source_svg
 
 
 def _compile_font(tofu_svg_path: pathlib.Path) -> pathlib.Path:
@@ -70,26 +192,30 @@ def _compile_font(tofu_svg_path: pathlib.Path) -> pathlib.Path:
 
     :returns: path to TTF file output
     """
+    version_major, version_minor, ascender, descender, line_gap, units_per_em, width = (
+        FLAGS.version_major, FLAGS.version_minor, FLAGS.ascender, FLAGS.descender,
+        FLAGS.line_gap, FLAGS.units_per_em, FLAGS.width)
+
     cmd = [
         'nanoemoji',
         '--family={}'.format(FAMILY_NAME),
         '--output_file={}'.format(FONT_FILENAME),
         '--color_format=glyf',
     ]
-    if FLAGS.version_major:
-        cmd.append('--version_major={}'.format(FLAGS.version_major))
-    if FLAGS.version_minor:
-        cmd.append('--version_minor={}'.format(FLAGS.version_minor))
-    if FLAGS.ascender:
-        cmd.append('--ascender={}'.format(FLAGS.ascender))
-    if FLAGS.descender:
-        cmd.append('--descender={}'.format(FLAGS.descender))
-    if FLAGS.line_gap:
-        cmd.append('--linegap={}'.format(FLAGS.line_gap))
-    if FLAGS.units_per_em:
-        cmd.append('--upem={}'.format(FLAGS.units_per_em))
-    if FLAGS.width:
-        cmd.append('--width={}'.format(FLAGS.width))
+    if version_major:
+        cmd.append('--version_major={}'.format(version_major))
+    if version_minor:
+        cmd.append('--version_minor={}'.format(version_minor))
+    if ascender:
+        cmd.append('--ascender={}'.format(ascender))
+    if descender:
+        cmd.append('--descender={}'.format(descender))
+    if line_gap:
+        cmd.append('--linegap={}'.format(line_gap))
+    if units_per_em:
+        cmd.append('--upem={}'.format(units_per_em))
+    if width:
+        cmd.append('--width={}'.format(width))
 
     cmd.append('{}'.format(tofu_svg_path))
     subprocess.run(cmd)
@@ -97,92 +223,219 @@ def _compile_font(tofu_svg_path: pathlib.Path) -> pathlib.Path:
     return pathlib.Path.cwd() / 'build' / FONT_FILENAME
 
 
-def _build_ttf() -> pathlib.Path:
+def _draw_tofu_glyph(tofu_svg_path: pathlib.Path, ascender: int, descender: int, width: int, units_per_em: int):
+    """
+    Draws the first painted shape of the tofu SVG into a TrueType glyph, the
+    same way nanoemoji does.
+
+    The SVG is normalized with picosvg, its viewBox is scaled to the
+    ascender/descender height and centered horizontally in the advance width,
+    and the cubic curves are converted to quadratic ones.
+
+    :returns: the glyph and its advance width
+    """
+    svg = SVG.parse(tofu_svg_path).topicosvg().clip_to_viewbox()
+    view_box = svg.view_box()
+    scale = (ascender - descender) / view_box.h
+    # Wide viewBoxes get a proportionally wider advance, as in nanoemoji's
+    # color_glyph._advance_width()
+    advance_width = max(width, round(scale * view_box.w))
+    svg_to_font = Affine2D.compose_ltr((
+        Affine2D(1, 0, 0, 1, -view_box.x, -view_box.y),
+        Affine2D(scale, 0, 0, scale, (advance_width - scale * view_box.w) / 2, 0),
+        # flip y axis so the glyph sits on the ascender
+        Affine2D(1, 0, 0, -1, 0, ascender),
+    ))
+
+    pen = TTGlyphPen(None)
+    # ufo2ft's default: max error of 1/1000 em, reversed to TrueType contour direction
+    cu2qu_pen = Cu2QuPen(pen, units_per_em / 1000, reverse_direction=True)
+    # Like the nanoemoji build, only the first painted shape becomes the tofu
+    shape = next((shape for shape in svg.shapes() if shape.as_path().d), None)
+    if shape is None:
+        raise app.UsageError('No painted shape found in {}'.format(tofu_svg_path))
+    parse_path(shape.as_path().apply_transform(svg_to_font).d, cu2qu_pen)
+    return pen.glyph(), advance_width
+
+
+def _tofu_font_builder() -> FontBuilder:
+    """Creates the Tofu font from scratch with just .notdef and the tofu glyph."""
+    version_major = FLAGS.version_major or DEFAULT_VERSION_MAJOR
+    version_minor = FLAGS.version_minor or DEFAULT_VERSION_MINOR
+    ascender = FLAGS.ascender or DEFAULT_ASCENDER
+    descender = FLAGS.descender or DEFAULT_DESCENDER
+    line_gap = FLAGS.line_gap or DEFAULT_LINE_GAP
+    units_per_em = FLAGS.units_per_em or DEFAULT_UNITS_PER_EM
+    width = FLAGS.width or DEFAULT_WIDTH
+
+    glyph, advance_width = _draw_tofu_glyph(_tofu_source_svg_path(), ascender, descender, width, units_per_em)
+    glyph.recalcBounds(None)
+
+    fb = FontBuilder(units_per_em, isTTF=True)
+    fb.setupGlyphOrder(['.notdef', GLYPH_NAME])
+    fb.setupGlyf({
+        '.notdef': NOTDEF_GLYPH,
+        GLYPH_NAME: glyph,
+    })
+    fb.setupHorizontalMetrics({
+        '.notdef': (width, 0),
+        GLYPH_NAME: (advance_width, glyph.xMin),
+    })
+    fb.setupHorizontalHeader(ascent=ascender, descent=descender, lineGap=line_gap, caretSlopeRise=units_per_em)
+    _setup_tofu_cmap(fb)
+
+    version = '{}.{:03d}'.format(version_major, version_minor)
+    ps_name = '{}-{}'.format(FAMILY_NAME, STYLE_NAME)
+    fb.setupNameTable({
+        'familyName': FAMILY_NAME,
+        'styleName': STYLE_NAME,
+        'uniqueFontIdentifier': '{};NONE;{}'.format(version, ps_name),
+        'fullName': '{} {}'.format(FAMILY_NAME, STYLE_NAME),
+        'version': 'Version {}'.format(version),
+        'psName': ps_name,
+    }, mac=False)
+    # ufo2ft's fontRevision (versionMajor.versionMinor) and defaults for
+    # openTypeHeadLowestRecPPEM (ufo2ft/fontInfoData.py) and maxp.maxZones
+    # (ufo2ft/outlineCompiler.py)
+    fb.font['head'].fontRevision = float(version)
+    fb.font['head'].lowestRecPPEM = 6
+    fb.font['maxp'].maxZones = 1
+
+    # Same values ufo2ft derives for nanoemoji's fonts: the vertical metrics and
+    # fsSelection come from nanoemoji's write_font._ufo(), xHeight/capHeight,
+    # the vendor ID and the win ascent/descent fallbacks from
+    # ufo2ft/fontInfoData.py, and the sub/superscript and strikeout formulas
+    # from OutlineCompiler.setupTable_OS2() in ufo2ft/outlineCompiler.py.
+    # Unicode ranges and char indices are given explicitly, and _TofuOS2 keeps
+    # the latter from being recomputed on compile; otherwise both would walk
+    # the format 13 subtable.
+    x_height = otRound(units_per_em * 0.5)
+    fb.setupOS2(
+        version=4,
+        achVendID='NONE',
+        # USE_TYPO_METRICS | REGULAR
+        fsSelection=0xC0,
+        sTypoAscender=ascender,
+        sTypoDescender=descender,
+        sTypoLineGap=line_gap,
+        usWinAscent=ascender + line_gap,
+        usWinDescent=-descender,
+        sxHeight=x_height,
+        sCapHeight=otRound(units_per_em * 0.7),
+        ySubscriptXSize=otRound(units_per_em * 0.65),
+        ySubscriptYSize=otRound(units_per_em * 0.6),
+        ySubscriptYOffset=otRound(units_per_em * 0.075),
+        ySuperscriptXSize=otRound(units_per_em * 0.65),
+        ySuperscriptYSize=otRound(units_per_em * 0.6),
+        ySuperscriptYOffset=otRound(units_per_em * 0.35),
+        yStrikeoutSize=otRound(units_per_em * 0.05),
+        yStrikeoutPosition=otRound(x_height * 0.6),
+        ulUnicodeRange1=1,
+        ulUnicodeRange2=0,
+        ulUnicodeRange3=0,
+        ulUnicodeRange4=0,
+        ulCodePageRange1=1,
+        # U+0001 from the format 4 subtable; U+10FFFF clamped to a USHORT
+        usFirstCharIndex=1,
+        usLastCharIndex=0xFFFF,
+    )
+    fb.font['OS/2'].__class__ = _TofuOS2
+    return fb
+
+
+def _setup_tofu_cmap(fb: FontBuilder):
+    """Maps (almost) every codepoint to the tofu glyph."""
+    # OTS is unhappy if we *only* have format 13
+    fb.setupCharacterMap({1: GLYPH_NAME})
+
+    # format 13: many to one
+    # https://docs.microsoft.com/en-us/typography/opentype/spec/cmap#format-13-many-to-one-range-mappings
+    # spec: subtable format 13 should only be used under platform ID 0 and encoding ID 6.
+    # https://github.com/behdad/tofudetector/blob/master/tofu.ttx uses 3/10 and that seems to work.
+    cmap_many_to_one = _TofuCmapSubtable()
+    cmap_many_to_one.platformID = 3
+    cmap_many_to_one.platEncID = 10
+    cmap_many_to_one.language = 0
+
+    fb.font['cmap'].tables.append(cmap_many_to_one)
+
+
+def _finish_ttf(fb: FontBuilder) -> bytes:
+    """
+    Adds the remaining tables and serializes the font.
+
+    :returns: the TTF file data
+    """
+    # Add an empty COLR and CPAL table so that the Tofu font can work on Color Emoji
+    fb.setupCOLR({})
+    fb.setupCPAL([[]])
+
+    fb.setupPost(keepGlyphNames=True)
+
+    ttf_file = io.BytesIO()
+    fb.save(ttf_file)
+
+    return ttf_file.getvalue()
+
+
+def _build_ttf() -> bytes:
+    # Only the composite tofu needs nanoemoji to split the SVG into glyph layers
+    if not FLAGS.support_composite:
+        return _finish_ttf(_tofu_font_builder())
+
     with tempfile.TemporaryDirectory() as tmpdir:
         os.chdir(tmpdir)
 
         # Copy tofu source SVG to tmp dir with filename expected by nanoemoji
         tofu_svg_path = pathlib.Path.cwd() / '0000.svg'
+        # shutil.copyfile already copies via sendfile(2) on Linux
         shutil.copyfile(_tofu_source_svg_path(), tofu_svg_path)
         ttf_file_path = _compile_font(tofu_svg_path)
 
-        with TTFont(ttf_file_path) as font:
+        with TTFont(ttf_file_path, lazy=True) as font:
             fb = FontBuilder(font=font)
-            if FLAGS.support_composite:
-                glyph_order = [n for n in font.getGlyphNames() if n != 'space']
-                glyphs = {n: fb.font['glyf'][n] for n in glyph_order}
-                horizontal_metrics = {n: fb.font['hmtx'][n] for n in glyph_order}
-                glyphs['.notdef'] = TTGlyphPen(None).glyph()
-                glyphs[GLYPH_NAME] = glyphs[glyph_order[-1]]
-                del glyphs[glyph_order[-1]]
-                horizontal_metrics[GLYPH_NAME] = horizontal_metrics[glyph_order[-1]]
-                del horizontal_metrics[glyph_order[-1]]
-                glyph_order[-1] = GLYPH_NAME
-            else:
-                glyph_order = ['.notdef', GLYPH_NAME]
-                for n in font.getGlyphNames():
-                    if n == '.notdef':
-                        continue
-                    glyph = fb.font['glyf'][n]
-                    if glyph.numberOfContours:
-                        break
-                glyphs = {
-                    '.notdef': TTGlyphPen(None).glyph(),
-                    GLYPH_NAME: glyph,
-                }
-                horizontal_metrics = {
-                    '.notdef': fb.font['hmtx']['.notdef'],
-                    GLYPH_NAME: fb.font['hmtx'][n],
-                }
+            # The last glyph is the composite tofu, renamed to GLYPH_NAME
+            source_names = [n for n in font.getGlyphNames() if n != 'space']
+            glyph_order = source_names[:-1] + [GLYPH_NAME]
+            glyf, hmtx = fb.font['glyf'], fb.font['hmtx']
+            glyphs = {n: glyf[src] for n, src in zip(glyph_order, source_names)}
+            glyphs['.notdef'] = NOTDEF_GLYPH
+            horizontal_metrics = {n: hmtx[src] for n, src in zip(glyph_order, source_names)}
 
             fb.setupGlyf(glyphs)
             fb.setupGlyphOrder(glyph_order)
             fb.setupHorizontalMetrics(horizontal_metrics)
+            _setup_tofu_cmap(fb)
 
-            # OTS is unhappy if we *only* have format 13
-            fb.setupCharacterMap({1: GLYPH_NAME})
-
-            # format 13: many to one
-            # https://docs.microsoft.com/en-us/typography/opentype/spec/cmap#format-13-many-to-one-range-mappings
-            # spec: subtable format 13 should only be used under platform ID 0 and encoding ID 6.
-            # https://github.com/behdad/tofudetector/blob/master/tofu.ttx uses 3/10 and that seems to work.
-            cmap_many_to_one = cmap_classes[13](13)
-            cmap_many_to_one.platformID = 3
-            cmap_many_to_one.platEncID = 10
-            cmap_many_to_one.language = 0
-            cmap_many_to_one.cmap = {cp: GLYPH_NAME for cp in range(
-                0x10FFFF + 1) if cp > 1 and cp != 0xFE0F}
-
-            fb.font['cmap'].tables.append(cmap_many_to_one)
-
-            # Add an empty COLR and CPAL table so that the Tofu font can work on Color Emoji
-            fb.setupCOLR({})
-            fb.setupCPAL([[]])
-
-            fb.setupPost(keepGlyphNames=True)
-
-            ttf_file_path = _script_path() / FONT_FILENAME
-            fb.save(ttf_file_path)
-
-            return ttf_file_path
+            return _finish_ttf(fb)
 
 
-def _create_css(ttf_file_path: pathlib.Path):
+def _create_css(ttf_data: bytes, css_file_path: pathlib.Path):
     """Create the stylesheet with inlined font data."""
-    css_file_path = ttf_file_path.parent / (ttf_file_path.stem + '.css')
-    with open(ttf_file_path, mode='rb') as ttf_file:
-        with open(css_file_path, mode='w') as css_file:
-            content = '@font-face {{\n' \
-                '  font-family: Tofu;\n' \
-                '  src: url("data:font/ttf;base64,{ttf_data}");\n' \
-                '}}\n'.format(ttf_data=b64encode(
-                    ttf_file.read()).decode('utf-8'))
-            css_file.write(content)
+    with open(css_file_path, mode='wb') as css_file, memoryview(ttf_data) as ttf_view:
+        css_file.write(b'@font-face {\n'
+                       b'  font-family: Tofu;\n'
+                       b'  src: url("data:font/ttf;base64,')
+        # Chunk size is a multiple of 3 so only the last chunk gets padded
+        for start in range(0, len(ttf_view), CSS_B64_CHUNK_SIZE):
+            css_file.write(b64encode(ttf_view[start:start + CSS_B64_CHUNK_SIZE]))
+        css_file.write(b'");\n'
+                       b'}\n')
 
 
 def _run(argv):
-    ttf_file_path = _build_ttf()
-    _create_css(ttf_file_path)
+    ttf_data = _build_ttf()
+
+    # The stylesheet is encoded from the in-memory font while the TTF is written
+    ttf_file_path = SCRIPT_PATH / FONT_FILENAME
+    css_file_path = ttf_file_path.with_suffix('.css')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(ttf_file_path.write_bytes, ttf_data),
+            executor.submit(_create_css, ttf_data, css_file_path),
+        ]
+        for future in futures:
+            future.result()
 
 
 def main():
@@ -1,10 +1,11 @@
 #! /bin/bash
 # Bash script for building the Tofu font.
 #
-# Uses the `nanoemoji` util to compile a font containing the tofu glyph in
-# the `source/` directory. The TTF output is further transformed to have the
+# Builds a font containing the tofu glyph in the `source/` directory. By default
+# the glyph is drawn directly from the SVG; with `--support_composite` the
+# `nanoemoji` util compiles the font first. Either way the font is given the
 # desired properties for our Tofu font (e.g. updating CMAP to map all codepoints
-# to .notdef).
+# to the tofu glyph).
 #
 # Additional outputs include `tofu.css`, which has the Tofu font binary data
 # inlined.